@@ -22,11 +22,11 @@ from Bio import AlignIO
 
 import os
 import shutil
-import glob
 import sys
 import argparse
 
 import pandas as pd
+import numpy as np
 import re
 
 from datetime import date
@@ -83,21 +83,26 @@ def delete_temp_directory(directory_name):
         shutil.rmtree(directory_name)
     return None
 
+
+def list_files(directory, suffix):
+    '''
+    lists the files in a directory that end with suffix (without changing directories)
+    returns a list of (file_name, file_path) tuples
+    '''
+    with os.scandir(directory) as it:
+        return [(entry.name, entry.path) for entry in it if entry.name.endswith(suffix) and entry.is_file()]
+
         
 def create_multi_fasta(fasta_files_dir_path, out_fasta):
     print('1A - generating multi sequence fasta')
     print('')
     
-    if os.path.exists(out_fasta):
-        os.remove(out_fasta)
-        
-        
-    os.chdir(fasta_files_dir_path)
-             
-    for file in glob.glob('*.fa'):
-        record = SeqIO.read(file, 'fasta')
-        with open(out_fasta, 'a') as outhandle:
-             SeqIO.write(record, outhandle, 'fasta')
+    # open the multi sequence fasta once with a large buffer and write every record to it
+    # (opening in 'w' mode also replaces any existing file)
+    with open(out_fasta, 'w', buffering = 1<<20) as outhandle:
+        for file_name, file in list_files(fasta_files_dir_path, '.fa'):
+            record = SeqIO.read(file, 'fasta')
+            SeqIO.write(record, outhandle, 'fasta')
     
     return None
 
@@ -153,12 +158,11 @@ def add_ref_genome(multifasta, ref_genome, fasta_temp_dir):
     return num_records
 
 def align_sequences(fasta_temp_dir, alignment_temp_dir, num_records):      
-    os.chdir(fasta_temp_dir)
     print('')
     print('2- aligning each sample sequence to reference genome and saving to temp alignments directory')
     
     n=0
-    for file in glob.glob('*.fasta'):
+    for file_name, file in list_files(fasta_temp_dir, '.fasta'):
         n = n + 1
         remainder = n%25
         if remainder == 0:
@@ -166,7 +170,7 @@ def align_sequences(fasta_temp_dir, alignment_temp_dir, num_records):
         elif n == num_records:
             print('  ....%d/%d complete' % (n, num_records))
             
-        sample_seq_name = file.split('.fasta')[0]
+        sample_seq_name = file_name.split('.fasta')[0]
 
         # create outpath file name for alignment
         alignment_file_name = os.path.join(alignment_temp_dir, '%s.alignment.fasta' % sample_seq_name)
@@ -182,6 +186,22 @@ def align_sequences(fasta_temp_dir, alignment_temp_dir, num_records):
     
     return None
 
+def find_gap_runs(aligned_seq_str):
+    '''
+    locates each run of "-" in an aligned sequence
+    the sequence is compared as a byte array so each run is found without the regex engine
+    returns a dictionary of numpy arrays {'starts', 'lengths'}
+    '''
+    seq_arr = np.frombuffer(aligned_seq_str.encode('ascii'), dtype = np.uint8)
+    is_gap = (seq_arr == ord('-')).view(np.int8)
+
+    # pad both ends so runs touching the start or end of the sequence are closed
+    edges = np.diff(np.concatenate(([0], is_gap, [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+
+    return {'starts': starts, 'lengths': ends - starts}
+
 def remove_insertions(alignment_temp_dir, ref_id, ref_seq ):
     print('')
     print('3- recording and removing insertions from sequences')
@@ -199,12 +219,11 @@ def remove_insertions(alignment_temp_dir, ref_id, ref_seq ):
     note_list = []
 
 
-    os.chdir(alignment_temp_dir)
 
     insertions_dict = {}
-    for file in glob.glob('*.alignment.fasta'):
-        if not re.search('mod', file):
-            alignment_name = file.split('.alignment')[0] # this should be the sample name
+    for file_name, file in list_files(alignment_temp_dir, '.alignment.fasta'):
+        if not re.search('mod', file_name):
+            alignment_name = file_name.split('.alignment')[0] # this should be the sample name
 
             # read each record in the alignmet (i.e. the ref sequence and the sample sequence)
             for record in AlignIO.read(file, 'fasta'):
@@ -213,10 +232,10 @@ def remove_insertions(alignment_temp_dir, ref_id, ref_seq ):
                 # if the record is the reference genome and there are "-" then that means there is a insertion in the sample sequence
                 if record.id == ref_id:
                     ref_alignment_seq_str = str(record.seq)
-                    if re.search('[-]+', ref_alignment_seq_str):
-                        insertions = re.findall('[-]+', ref_alignment_seq_str) # the lenght of this tells us how many insertions ther are
+                    gap_runs = find_gap_runs(ref_alignment_seq_str)
+                    if gap_runs['starts'].size > 0:
 #                         print('')
-                        print('  ....found %d insertion(s) in %s' % (len(insertions), alignment_name))
+                        print('  ....found %d insertion(s) in %s' % (gap_runs['starts'].size, alignment_name))
                      
 
                         # now get the sample record
@@ -226,14 +245,13 @@ def remove_insertions(alignment_temp_dir, ref_id, ref_seq ):
 
                         moving_length = 0
                         k = 0
-                        for i in re.finditer('[-]+', ref_alignment_seq_str):
+                        for run_start, length in zip(gap_runs['starts'].tolist(), gap_runs['lengths'].tolist()):
                             k = k + 1
-    #                         print('.........removing insertion %d of %d' % (k, len(insertions)))
+    #                         print('.........removing insertion %d of %d' % (k, gap_runs['starts'].size))
 
                             seq_list.append(alignment_name)
 
-                            start = i.start()  - moving_length # account for previous insertions removed
-                            length = i.end() - i.start()  # gets you teh insertion length
+                            start = run_start - moving_length # account for previous insertions removed
                 
                             if start != 22204 and length != 9:
 
@@ -323,26 +341,22 @@ def record_deletions(alignment_temp_dir, ref_seq, mod_seq_list):
     downstream_list = []
     note_list = []
 
-    os.chdir(alignment_temp_dir)
 
-    for file in glob.glob('*.alignment.fasta'):
+    for file_name, file in list_files(alignment_temp_dir, '.alignment.fasta'):
 
         # use the mod file for the sequences where the insertion was removed...
-        if re.search('mod', file):
-            alignment_name = file.split('_mod.alignment.fasta')[0] 
+        if re.search('mod', file_name):
+            alignment_name = file_name.split('_mod.alignment.fasta')[0] 
             record = SeqIO.read(file, 'fasta')
             seq_str = str(record.seq)
-            if re.search('[-]+', seq_str):
-                deletions = re.findall('[-]+', seq_str)
-#                 print('....found %d deletion(s) in %s' % (len(deletions), alignment_name))
+            gap_runs = find_gap_runs(seq_str)
+            if gap_runs['starts'].size > 0:
+#                 print('....found %d deletion(s) in %s' % (gap_runs['starts'].size, alignment_name))
 
-                for i in re.finditer('[-]+', seq_str):
+                for start, length in zip(gap_runs['starts'].tolist(), gap_runs['lengths'].tolist()):
 
                     # locate first deletion, record size and location, repeat for next deletion
-                    start = i.start()
                     if start != 0:
-                        length = i.end() - i.start()
-
                         start_list.append(start)
                         length_list.append(length)
                         seq_list.append(alignment_name)
@@ -360,23 +374,20 @@ def record_deletions(alignment_temp_dir, ref_seq, mod_seq_list):
                         downstream_list.append(downstream)
 
         else:
-            alignment_name = file.split('.alignment.fasta')[0]
+            alignment_name = file_name.split('.alignment.fasta')[0]
 
             if alignment_name not in mod_seq_list:
                 for record in AlignIO.read(file, 'fasta'):
                     seq_str = str(record.seq)
 
-                    if re.search('[-]+', seq_str) and record.id == alignment_name:
-                        deletions = re.findall('[-]+', seq_str)
-#                         print('....found %d deletion(s) in %s' % (len(deletions), alignment_name))
+                    if record.id == alignment_name:
+                        gap_runs = find_gap_runs(seq_str)
+#                         print('....found %d deletion(s) in %s' % (gap_runs['starts'].size, alignment_name))
 
-                        for i in re.finditer('[-]+', seq_str):
+                        for start, length in zip(gap_runs['starts'].tolist(), gap_runs['lengths'].tolist()):
 
                             # locate first deletion, record size and location, repeat for next deletion
-                            start = i.start()
                             if start != 0:
-                                length = i.end() - i.start()
-
                                 start_list.append(start)
                                 length_list.append(length)
                                 seq_list.append(alignment_name)
@@ -408,23 +419,10 @@ def join_insertion_and_deletions_dfs(insertions_df, deletions_df, prefix, wd):
     print('')
     print('5- writing indel table to csv')
     
-    if insertions_df.shape[0] > 0 and deletions_df.shape[0] > 0:
-        dataframe_list = [insertions_df, deletions_df]
-        joined_df = pd.concat(dataframe_list)
-    elif insertions_df.shape[0] > 0:
-        joined_df = insertions_df
-    elif deletions_df.shape[0] >0:
-        joined_df = deletions_df
-    else:
-        joined_df = pd.DataFrame()
-        joined_df['accession_id'] = ''
-        joined_df['indel'] = ''
-        joined_df['start_pos'] = ''
-        joined_df['length'] = ''
-        joined_df['upstream_ref'] = ''
-        joined_df['downstream_ref'] = ''
-        joined_df['note'] = ''
-        
+    # both dataframes have the same columns (and are empty rather than missing when nothing is found)
+    # so they can always be concatenated
+    joined_df = pd.concat([insertions_df, deletions_df], ignore_index = True)
+
     outfile = os.path.join(wd, '%s_indels.csv' % prefix)
     joined_df.to_csv(outfile, index = False)
     print('  ....indel table csv file name: %s' % outfile)
@@ -445,9 +443,8 @@ def create_concatenated_seq_records(wd, temp_alignment_dir, mod_seq_list, ref_ge
 #         SeqIO.write(ref_genome, handle, 'fasta')
         
     # first append the non - modified records
-    os.chdir(temp_alignment_dir)
-    for file in glob.glob('*.fasta'):
-        sample_name = file.split('.alignment.fasta')[0]
+    for file_name, file in list_files(temp_alignment_dir, '.fasta'):
+        sample_name = file_name.split('.alignment.fasta')[0]
         if sample_name not in mod_seq_list:
             for record in AlignIO.read(file, 'fasta'):
                 if record.id == sample_name:
@@ -455,7 +452,7 @@ def create_concatenated_seq_records(wd, temp_alignment_dir, mod_seq_list, ref_ge
                         SeqIO.write(record, handle, 'fasta')
             
     # now append the records from the mod_seq_list
-    for file in glob.glob('*_mod.alignment.fasta'):
+    for file_name, file in list_files(temp_alignment_dir, '_mod.alignment.fasta'):
         record = SeqIO.read(file, 'fasta')
         with open(concat_fasta_outfile, 'a') as handle:
             SeqIO.write(record, handle, 'fasta')
@@ -17,16 +17,17 @@
 from Bio import SeqIO
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
-from Bio.Align.Applications import MafftCommandline
-from Bio import AlignIO
 
 import os
-import shutil
-import glob
 import sys
 import argparse
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
+import numpy as np
+from numba import njit
 import re
 
 from datetime import date
@@ -49,352 +50,545 @@ def getOptions(args=sys.argv[1:]):
 
 def get_ref_seq_record(ref_genome_path):
     ref = SeqIO.read(ref_genome_path, 'fasta')
-    return {'ref_record': ref, 'ref_id': ref.id, 'ref_seq': ref.seq}
 
+    # the reference is encoded once as a read only uint8 array; it is shared with the alignment
+    # workers and sliced for the indel table without re-encoding
+    # (uppercased, like the sample sequences, because banded_align compares bases case-sensitively)
+    ref_arr = np.frombuffer(bytes(ref.seq).upper(), dtype = np.uint8)
+    return {'ref_record': ref, 'ref_id': ref.id, 'ref_seq': ref.seq, 'ref_arr': ref_arr}
 
 
-def create_temp_directories(wd):
-    '''
-    creates two temp directories for the alignment of each sequence to the reference genome
-    these temp directories will be deleted at the end
-    '''
-    # get date
-    today_date = str(date.today())
-
-    # create tempory directory to store fastas and alignments
-    fasta_temp_dir = os.path.join(wd, 'temp-fastas_%s' % today_date)
-    alignment_temp_dir = os.path.join(wd, 'temp-alignments_%s' % today_date)
-
-    if os.path.exists(fasta_temp_dir):
-        shutil.rmtree(fasta_temp_dir)
-
-    if os.path.exists(alignment_temp_dir):
-        shutil.rmtree(alignment_temp_dir)
-
-    os.makedirs(fasta_temp_dir)
-    os.makedirs(alignment_temp_dir)
-
-    return {'alignment_temp_dir' : alignment_temp_dir, 'fasta_temp_dir': fasta_temp_dir}
-
-
-def delete_temp_directory(directory_name):
-    if os.path.exists(directory_name):
-        print('removing the temp directory: %s' % directory_name)
-        shutil.rmtree(directory_name)
-    return None
-
 
 def create_multi_fasta(fasta_files_dir_path, out_fasta):
     print('1A - generating multi sequence fasta')
     print('')
 
-    if os.path.exists(out_fasta):
-        os.remove(out_fasta)
-
-
-    os.chdir(fasta_files_dir_path)
+    # list the single sequence fasta files without changing directories
+    with os.scandir(fasta_files_dir_path) as it:
+        fasta_files = [entry.path for entry in it if entry.name.endswith('.fa') and entry.is_file()]
 
-    for file in glob.glob('*.fa'):
-        record = SeqIO.read(file, 'fasta')
-        with open(out_fasta, 'a') as outhandle:
-             SeqIO.write(record, outhandle, 'fasta')
+    # open the multi sequence fasta once with a large buffer and write every record to it
+    with open(out_fasta, 'w', buffering = 1<<20) as outhandle:
+        for file in fasta_files:
+            record = SeqIO.read(file, 'fasta')
+            SeqIO.write(record, outhandle, 'fasta')
 
     return None
 
-def add_ref_genome(multifasta, ref_genome, fasta_temp_dir):
+def count_records(multifasta):
     '''
-    generates a fasta file for each sequence that contains the reference sequence and sample sequence
-    these are saved to the temp fasta files directory
+    counts the sequences in the multifasta and warns about any duplicated record.ids
     '''
-    # how many sequnces are in the fasta file:
-    num_records = len(list(SeqIO.parse(multifasta, "fasta")))
-    print('1- adding reference genome to each sequence and saving to temp fasta files directory')
-    print('  ....there are %d sequences' % num_records)
-
-    # are any seqeunces duplicated in the multifasta?? If so, print warning because only one of the
-    # duplicates will be proccessed becasue the files will be overwritten
-
+    # how many sequnces are in the fasta file and are any seqeunces duplicated in the multifasta??
+    # If so, print warning because only one of the duplicates will be proccessed becasue the
+    # later records are skipped; both are found in a single pass over the file
+    num_records = 0
+    all_records = set()
     duplicated_records = []
-    all_records = []
     for record in SeqIO.parse(multifasta, 'fasta'):
+        num_records = num_records + 1
         if record.id not in all_records:
-            all_records.append(record.id)
+            all_records.add(record.id)
         else:
             duplicated_records.append(record.id)
 
-
+    print('1- reading sample sequences from the multi sequence fasta')
+    print('  ....there are %d sequences' % num_records)
     print('  ....there are %d records with same record.id in the multifasta' % len(duplicated_records))
-    print('  ....any records with the same record.id will not get processed; the file will be overwritten')
+    print('  ....any records with the same record.id will not get processed; only the first is aligned')
     if len(duplicated_records) > 0 :
         print('  ....the records wtih the same record.id are:')
         for record in duplicated_records:
             print(  '  ........ %s' % record)
 
-    n = 0
-
-    for record in SeqIO.parse(multifasta, 'fasta'):
-        n = n + 1
-
-        # reset_records list
-        records = [ref_genome]
-
-        # get record from fasta file
-#         print(n, record.id)
-
-        #append record to reference genome
-        records.append(record)
-
-        #write records list to a fasta file
-        path = os.path.join(fasta_temp_dir, '%s.fasta' % record.id)
-
-        with open(path, 'w') as handle:
-            SeqIO.write(records, handle, 'fasta')
-
     return num_records
 
-def align_sequences(fasta_temp_dir, alignment_temp_dir, num_records):
-    os.chdir(fasta_temp_dir)
-    print('')
-    print('2- aligning each sample sequence to reference genome and saving to temp alignments directory')
-
-    n=0
-    for file in glob.glob('*.fasta'):
-        n = n + 1
-        remainder = n%25
-        if remainder == 0 or n == 1:
-            print('  ....%d/%d complete' % (n, num_records))
-        elif n == num_records:
-            print('  ....%d/%d complete' % (n, num_records))
-
-        sample_seq_name = file.split('.fasta')[0]
-
-        # create outpath file name for alignment
-        alignment_file_name = os.path.join(alignment_temp_dir, '%s.alignment.fasta' % sample_seq_name)
-
-        if not os.path.isfile(alignment_file_name):
-
-            # do alignment
-            mafft_cline = MafftCommandline (input=file)
-#             print(mafft_cline)
-            stdout, stderr = mafft_cline()
-            with open(alignment_file_name, 'w') as handle:
-                handle.write(stdout)
-
-    return None
-
-def remove_insertions(alignment_temp_dir, ref_id, ref_seq ):
-    print('')
-    print('3- recording but NOT removing insertions from sequences')
-
-    ref_seq = str(ref_seq)
-
-    # prepare empty lists for data table
-    seq_list = []
-    ref_start_list = []
-    seq_start_list = []
-    length_list = []
-    ref_seq_list = []
-    upstream_list = []
-    downstream_list = []
-
-
-    os.chdir(alignment_temp_dir)
-
-    insertions_dict = {}
-    for file in glob.glob('*.alignment.fasta'):
-        alignment_name = file.split('.alignment')[0] # this should be the sample name
-
-        # read each record in the alignmet (i.e. the ref sequence and the sample sequence)
-        for record in AlignIO.read(file, 'fasta'):
-
-            # only perform the following code if find insertions in ref alignment
-            # if the record is the reference genome and there are "-" then that means there is a insertion in the sample sequence
-            if record.id == ref_id:
-                ref_alignment_seq_str = str(record.seq)
-                if re.search('[-]+', ref_alignment_seq_str):
-                    insertions = re.findall('[-]+', ref_alignment_seq_str) # the lenght of this tells us how many insertions ther are
-#                         print('')
-                    print('  ....found %d insertion(s) in %s' % (len(insertions), alignment_name))
-
-
-                    # now get the sample record
-                    for sample_record in AlignIO.read(file, 'fasta'):
-                        if sample_record.id == alignment_name:
-                            sample_seq_str = str(sample_record.seq)
-
-                    moving_length = 0
-                    k = 0
-                    for i in re.finditer('[-]+', ref_alignment_seq_str):
-                        k = k + 1
-#                         print('.........removing insertion %d of %d' % (k, len(insertions)))
-
-                        seq_list.append(alignment_name)
-
-                        ref_start = i.start() - moving_length # account for previous insertions removed
-                        seq_start = i.start()
-                        length = i.end() - i.start()  # gets you teh insertion length
-
-                        ref_start_list.append(ref_start)
-                        seq_start_list.append(seq_start)
-                        length_list.append(length)
-
-                        # get bp around teh insertion from the sample sequence
-                        insert_nucleotides = sample_seq_str[seq_start: seq_start+length]
-                        ref_seq_list.append('+%s' % insert_nucleotides)
-
-                        # get the sequence around the insert from the reference
-                        upstream = ref_seq[seq_start-7: seq_start]
-                        downstream = ref_seq[seq_start: seq_start + 7]
-
-                        upstream_list.append(upstream)
-                        downstream_list.append(downstream)
+# alignment scores (same as the biopython PairwiseAligner settings used previously)
+MATCH_SCORE = 2
+MISMATCH_SCORE = -1
+OPEN_GAP_SCORE = -10 # score of the first position in a gap
+EXTEND_GAP_SCORE = -1
+# sample sequences are nearly identical to the reference so only the diagonals within
+# BAND of the main diagonal are filled in (plus the difference in sequence length)
+BAND = 256
+# the band is widened by the difference in sequence length and the traceback needs (ref length x band width)
+# bytes, so empty records and samples whose length differs from the reference by more than this are skipped
+MAX_LENGTH_DIFF = 1000
+
+@njit(cache = True)
+def banded_align(ref_arr, query_arr, band):
+    '''
+    global alignment with affine gap scores (gotoh) of a sample sequence to the reference genome,
+    restricted to a diagonal band; both sequences are uint8 arrays
+    one traceback byte is kept per cell in the band
+    returns (aligned_ref_arr, aligned_query_arr) as uint8 arrays with "-" for gaps
+    '''
+    gap = 45 # ord('-')
+    neg = -1000000000
+    n = ref_arr.shape[0]
+    m = query_arr.shape[0]
+
+    # diagonal d = j - i; row i of the band holds the columns j = i + d_lo ... i + d_hi
+    d_lo = min(0, m - n) - band
+    d_hi = max(0, m - n) + band
+    width = d_hi - d_lo + 1
+
+    # traceback bits: 0-1 state before a M cell, 2-3 state before a X cell, 4-5 state before a Y cell
+    # states: 0 = M (ref and sample aligned), 1 = X (gap in sample), 2 = Y (gap in reference)
+    trace = np.zeros((n + 1, width), dtype = np.uint8)
+
+    prev_m = np.full(width, neg, dtype = np.int32)
+    prev_x = np.full(width, neg, dtype = np.int32)
+    prev_y = np.full(width, neg, dtype = np.int32)
+    cur_m = np.full(width, neg, dtype = np.int32)
+    cur_x = np.full(width, neg, dtype = np.int32)
+    cur_y = np.full(width, neg, dtype = np.int32)
+
+    for i in range(n + 1):
+        for k in range(width):
+            j = i + d_lo + k
+            cur_m[k] = neg
+            cur_x[k] = neg
+            cur_y[k] = neg
+            if j < 0 or j > m:
+                continue
+            if i == 0 and j == 0:
+                cur_m[k] = 0
+                continue
+
+            tb = 0
+            # M: diagonal step, same k in the previous row
+            if i > 0 and j > 0:
+                best = prev_m[k]
+                src = 0
+                if prev_x[k] > best:
+                    best = prev_x[k]
+                    src = 1
+                if prev_y[k] > best:
+                    best = prev_y[k]
+                    src = 2
+                if best > neg:
+                    if ref_arr[i - 1] == query_arr[j - 1]:
+                        cur_m[k] = best + MATCH_SCORE
+                    else:
+                        cur_m[k] = best + MISMATCH_SCORE
+                tb = tb | src
+
+            # X: step down the reference, k + 1 in the previous row
+            if i > 0 and k + 1 < width:
+                best = prev_m[k + 1] + OPEN_GAP_SCORE
+                src = 0
+                if prev_x[k + 1] + EXTEND_GAP_SCORE > best:
+                    best = prev_x[k + 1] + EXTEND_GAP_SCORE
+                    src = 1
+                if prev_y[k + 1] + OPEN_GAP_SCORE > best:
+                    best = prev_y[k + 1] + OPEN_GAP_SCORE
+                    src = 2
+                if best > neg:
+                    cur_x[k] = best
+                tb = tb | (src << 2)
+
+            # Y: step along the sample, k - 1 in the current row
+            if j > 0 and k > 0:
+                best = cur_m[k - 1] + OPEN_GAP_SCORE
+                src = 0
+                if cur_y[k - 1] + EXTEND_GAP_SCORE > best:
+                    best = cur_y[k - 1] + EXTEND_GAP_SCORE
+                    src = 2
+                if cur_x[k - 1] + OPEN_GAP_SCORE > best:
+                    best = cur_x[k - 1] + OPEN_GAP_SCORE
+                    src = 1
+                if best > neg:
+                    cur_y[k] = best
+                tb = tb | (src << 4)
+
+            trace[i, k] = tb
+
+        prev_m, cur_m = cur_m, prev_m
+        prev_x, cur_x = cur_x, prev_x
+        prev_y, cur_y = cur_y, prev_y
+
+    # trace back from the bottom right cell
+    k = m - n - d_lo
+    state = 0
+    if prev_x[k] > prev_m[k]:
+        state = 1
+    if prev_y[k] > prev_m[k] and prev_y[k] > prev_x[k]:
+        state = 2
+
+    aligned_ref = np.empty(n + m, dtype = np.uint8)
+    aligned_query = np.empty(n + m, dtype = np.uint8)
+    pos = n + m
+    i = n
+    j = m
+    while i > 0 or j > 0:
+        k = j - i - d_lo
+        tb = trace[i, k]
+        pos = pos - 1
+        if state == 0:
+            aligned_ref[pos] = ref_arr[i - 1]
+            aligned_query[pos] = query_arr[j - 1]
+            state = tb & 3
+            i = i - 1
+            j = j - 1
+        elif state == 1:
+            aligned_ref[pos] = ref_arr[i - 1]
+            aligned_query[pos] = gap
+            state = (tb >> 2) & 3
+            i = i - 1
+        else:
+            aligned_ref[pos] = gap
+            aligned_query[pos] = query_arr[j - 1]
+            state = (tb >> 4) & 3
+            j = j - 1
+
+    return aligned_ref[pos:], aligned_query[pos:]
+
+# aligned sequences are stored as 4 bit nucleotide codes, two alignment columns per byte
+# (low nibble = even column, high nibble = odd column); they are decoded only for output
+NT_ALPHABET = b'ACGTN-RYKMSWBDHV'
+GAP_CODE = 5 # NT_ALPHABET.index(b'-')
+NT_ENCODE = np.full(256, NT_ALPHABET.index(b'N'), dtype = np.uint8) # anything outside the alphabet is written as N
+for code, nt in enumerate(NT_ALPHABET):
+    NT_ENCODE[nt] = code
+    NT_ENCODE[ord(chr(nt).lower())] = code
+NT_DECODE = np.frombuffer(NT_ALPHABET, dtype = np.uint8)
+
+@njit(cache = True)
+def encode_nt(arr, encode_table):
+    '''
+    packs a uint8 array of nucleotides into 4 bit codes, two per byte
+    '''
+    packed = np.zeros((arr.shape[0] + 1) // 2, dtype = np.uint8)
+    for i in range(arr.shape[0]):
+        packed[i >> 1] = packed[i >> 1] | (encode_table[arr[i]] << ((i & 1) * 4))
+    return packed
 
-                        # update moving length
-                        moving_length = moving_length + length
+@njit(cache = True)
+def decode_nt(packed, start, stop, decode_table):
+    '''
+    unpacks columns start ... stop - 1 of a packed sequence back into a uint8 array of nucleotides
+    '''
+    arr = np.empty(stop - start, dtype = np.uint8)
+    for i in range(start, stop):
+        arr[i - start] = decode_table[(packed[i >> 1] >> ((i & 1) * 4)) & 15]
+    return arr
 
+def decode_slice(packed, aln_len, start, stop):
+    '''
+    returns packed_seq[start: stop] as bytes; follows python slice rules so negative starts behave
+    the same as slicing the unpacked sequence
+    '''
+    start, stop, step = slice(start, stop).indices(aln_len)
+    if stop <= start:
+        return b''
+    return decode_nt(packed, start, stop, NT_DECODE).tobytes()
 
+def init_aligner(ref_arr):
+    '''
+    runs once in each worker process; keeps the encoded reference sequence array
+    so it is not rebuilt (or pickled) for every sample
+    '''
+    global worker_ref_arr
+    worker_ref_arr = ref_arr
 
-    # fill in pandas table
-    df = pd.DataFrame()
-    df['accession_id'] = seq_list
-    df['indel'] = ref_seq_list
-    df['ref_start_pos'] = ref_start_list
-    df['seq_start_pos'] = seq_start_list
-    df['length'] = length_list
-    df['upstream_ref'] = upstream_list
-    df['downstream_ref'] = downstream_list
+def align_one(record_tuple):
+    '''
+    aligns a single (sample_id, sample_seq_bytes) tuple to the reference genome
+    returns (sample_id, packed_ref, packed_sample, aln_len); the aligned rows are packed 4 bit codes
+    '''
+    sample_id, sample_seq = record_tuple
 
-    return {'insertions_df': df, 'mod_seq_list': seq_list}
+    query_arr = np.frombuffer(sample_seq, dtype = np.uint8)
+    aligned_ref, aligned_sample = banded_align(worker_ref_arr, query_arr, BAND)
+    return (sample_id,
+            encode_nt(aligned_ref, NT_ENCODE),
+            encode_nt(aligned_sample, NT_ENCODE),
+            aligned_ref.shape[0])
 
-def record_deletions(alignment_temp_dir, ref_seq, mod_seq_list, ref_id):
+def pairwise_align_sequences(multifasta, ref_arr, num_records):
+    '''
+    aligns each sample sequence to the reference genome in memory (banded global pairwise alignment)
+    samples are independent so they are aligned in parallel, one worker process per cpu
+    generator; yields (sample_id, packed_ref, packed_sample, aln_len) in the order of the multifasta
+    so each alignment can be used and dropped without holding all of them in memory; only a small
+    window of samples (4 per worker) is read from the multifasta and in flight at any time
+    '''
     print('')
-    print('4- recording deletions')
-
-    # prepare empty lists for data table
-#     ref_seq = str(ref_seq)
-
-    seq_list = []
-    ref_start_list = []
-    seq_start_list = []
-    length_list = []
-    ref_seq_list = []
-    upstream_list = []
-    downstream_list = []
-
-    os.chdir(alignment_temp_dir)
-
-    for file in glob.glob('*.alignment.fasta'):
-
-        alignment_name = file.split('.alignment.fasta')[0]
-
-        for record in AlignIO.read(file, 'fasta'):
-            if record.id == ref_id:
-                ref_str = str(record.seq)
-
-                for record in AlignIO.read(file, 'fasta'):
-                    if record.id == alignment_name:
-                        seq_str = str(record.seq)
+    print('2- aligning each sample sequence to reference genome, recording indels and writing the MSA')
+    print('  ....using %d worker processes' % os.cpu_count())
+
+    # only the first record with a given record.id is aligned; empty records and records too far from
+    # the reference length for the banded alignment are skipped
+    seen_ids = set()
+    def unique_records():
+        for record in SeqIO.parse(multifasta, 'fasta'):
+            if record.id in seen_ids:
+                continue
+            seen_ids.add(record.id)
+
+            length_diff = abs(len(record.seq) - ref_arr.shape[0])
+            if len(record.seq) == 0:
+                print('  ....skipping %s: the sequence is empty' % record.id)
+            elif length_diff > MAX_LENGTH_DIFF:
+                print('  ....skipping %s: the sequence length (%d) differs from the reference by more than %d bp' % (record.id, len(record.seq), MAX_LENGTH_DIFF))
+            else:
+                # banded_align compares bytes, so lowercase bases would all count as mismatches
+                yield (record.id, bytes(record.seq).upper())
+
+    # ex.map would submit (and read) every sample before yielding the first result, so the samples
+    # are submitted through a bounded window instead; a new sample is submitted as each result is taken
+    records = unique_records()
+    window = os.cpu_count() * 4
+    pending = deque()
 
-                        if re.search('[-]+', seq_str) and record.id == alignment_name:
-                            deletions = re.findall('[-]+', seq_str)
-            #                         print('....found %d deletion(s) in %s' % (len(deletions), alignment_name))
-
-                            for i in re.finditer('[-]+', seq_str):
+    n=0
+    with ProcessPoolExecutor(max_workers = os.cpu_count(),
+                             initializer = init_aligner,
+                             initargs = (ref_arr,)) as ex:
+        for record_tuple in itertools.islice(records, window):
+            pending.append(ex.submit(align_one, record_tuple))
+
+        while pending:
+            alignment = pending.popleft().result()
+            for record_tuple in itertools.islice(records, 1):
+                pending.append(ex.submit(align_one, record_tuple))
+
+            n = n + 1
+            remainder = n%25
+            if remainder == 0 or n == 1:
+                print('  ....%d/%d complete' % (n, num_records))
+
+            yield alignment
+
+    # num_records also counts the duplicated and skipped records, so the final count is printed here
+    if n%25 != 0 and n != 1:
+        print('  ....%d/%d complete' % (n, num_records))
+    print('  ....%d records aligned, %d duplicated or skipped' % (n, num_records - n))
+
+# indel kinds written by the scan_indels kernel
+INSERTION = 1 # run of "-" in the aligned reference
+DELETION = 2 # run of "-" in the aligned sample sequence
+
+@njit(cache = True)
+def scan_indels(packed_ref, packed_sample, aln_len, out_starts, out_lens, out_kind, out_ref_starts):
+    '''
+    single pass over a pairwise alignment (both rows as packed 4 bit codes) that records every run of "-"
+    writes the alignment start, length, kind and reference start of each run to the preallocated
+    output arrays and returns the number of runs found
+    '''
+    n = 0
+    moving_length = 0 # total length of the insertions seen so far
+    ins_start = -1
+    del_start = -1
+
+    for i in range(aln_len + 1):
+        shift = (i & 1) * 4
+        ref_is_gap = i < aln_len and ((packed_ref[i >> 1] >> shift) & 15) == GAP_CODE
+        sample_is_gap = i < aln_len and ((packed_sample[i >> 1] >> shift) & 15) == GAP_CODE
+
+        if ref_is_gap and ins_start == -1:
+            ins_start = i
+        elif not ref_is_gap and ins_start != -1:
+            out_starts[n] = ins_start
+            out_lens[n] = i - ins_start
+            out_kind[n] = INSERTION
+            out_ref_starts[n] = ins_start - moving_length # account for previous insertions
+            moving_length = moving_length + i - ins_start
+            n = n + 1
+            ins_start = -1
+
+        if sample_is_gap and del_start == -1:
+            del_start = i
+        elif not sample_is_gap and del_start != -1:
+            out_starts[n] = del_start
+            out_lens[n] = i - del_start
+            out_kind[n] = DELETION
+            out_ref_starts[n] = -1
+            n = n + 1
+            del_start = -1
+
+    return n
+
+def find_indels(packed_ref, packed_sample, aln_len):
+    '''
+    runs the scan_indels kernel over one pairwise alignment (both rows as packed 4 bit codes)
+    returns a dictionary of numpy arrays {'starts', 'lengths', 'kind', 'ref_starts'}
+    '''
+    # there can never be more gap runs than alignment columns
+    out_starts = np.empty(aln_len, dtype = np.int32)
+    out_lens = np.empty(aln_len, dtype = np.int32)
+    out_kind = np.empty(aln_len, dtype = np.int8)
+    out_ref_starts = np.empty(aln_len, dtype = np.int32)
 
-                                # locate first deletion, record size and location, repeat for next deletion
-                                seq_start = i.start()
-                                if seq_start != 0:
-                                    length = i.end() - i.start()
+    n = scan_indels(packed_ref, packed_sample, aln_len, out_starts, out_lens, out_kind, out_ref_starts)
 
-                                    seq_start_list.append(seq_start)
-                                    ref_start_list.append('')
-                                    length_list.append(length)
-                                    seq_list.append(alignment_name)
+    return {'starts': out_starts[:n], 'lengths': out_lens[:n],
+            'kind': out_kind[:n], 'ref_starts': out_ref_starts[:n]}
 
-                                    # get the ref sequence
-                                    insert_nucleotides = ref_str[seq_start: seq_start+length]
-                                    ref_seq_list.append('-%s' % insert_nucleotides)
+def extract_indels(packed_ref, packed_sample, aln_len, sample_id, ref_arr):
+    '''
+    records the insertions and deletions in one pairwise alignment from a single scan of both rows
+    if the reference genome has "-" then that means there is a insertion in the sample sequence;
+    if the sample sequence has "-" then that means there is a deletion in the sample sequence
+    the alignment rows are packed 4 bit codes and ref_arr is the uint8 reference; only the nucleotides around each indel
+    are decoded and they stay bytes until the dataframe is built
+    returns a dictionary of {'insertions': columns, 'deletions': columns}
+    '''
+    indels = find_indels(packed_ref, packed_sample, aln_len)
+
+    # insertions
+    is_insertion = indels['kind'] == INSERTION
+    ins_starts = indels['starts'][is_insertion]
+    ins_lengths = indels['lengths'][is_insertion]
+
+    ins_seq_list = []
+    ins_upstream_list = []
+    ins_downstream_list = []
+    for seq_start, length in zip(ins_starts.tolist(), ins_lengths.tolist()):
+        # get bp around teh insertion from the sample sequence
+        ins_seq_list.append(b'+' + decode_slice(packed_sample, aln_len, seq_start, seq_start+length))
+
+        # get the sequence around the insert from the reference
+        ins_upstream_list.append(ref_arr[seq_start-7: seq_start].tobytes())
+        ins_downstream_list.append(ref_arr[seq_start: seq_start + 7].tobytes())
+
+    # deletions; a "-" at the very start of the sample sequence is not recorded as a deletion
+    is_deletion = (indels['kind'] == DELETION) & (indels['starts'] != 0)
+    del_starts = indels['starts'][is_deletion]
+    del_lengths = indels['lengths'][is_deletion]
+
+    del_seq_list = []
+    del_upstream_list = []
+    del_downstream_list = []
+    for seq_start, length in zip(del_starts.tolist(), del_lengths.tolist()):
+        # get the ref sequence
+        del_seq_list.append(b'-' + decode_slice(packed_ref, aln_len, seq_start, seq_start+length))
+
+        # get the sequence around the deletion
+        del_upstream_list.append(decode_slice(packed_ref, aln_len, seq_start-7, seq_start))
+        del_downstream_list.append(decode_slice(packed_ref, aln_len, seq_start, seq_start + 7))
+
+    insertions = {'accession_id': sample_id,
+                  'indel': ins_seq_list,
+                  'ref_start_pos': indels['ref_starts'][is_insertion],
+                  'seq_start_pos': ins_starts,
+                  'length': ins_lengths,
+                  'upstream_ref': ins_upstream_list,
+                  'downstream_ref': ins_downstream_list}
+
+    deletions = {'accession_id': sample_id,
+                 'indel': del_seq_list,
+                 'ref_start_pos': indels['ref_starts'][is_deletion],
+                 'seq_start_pos': del_starts,
+                 'length': del_lengths,
+                 'upstream_ref': del_upstream_list,
+                 'downstream_ref': del_downstream_list}
+
+    return {'insertions': insertions, 'deletions': deletions}
+
+# columns of the indel table; the insertion and deletion dataframes always share this schema
+INDEL_COLUMNS = ['accession_id', 'indel', 'ref_start_pos', 'seq_start_pos', 'length', 'upstream_ref', 'downstream_ref']
+
+def concat_indel_columns(column_dict_list):
+    '''
+    joins the per sample columns from extract_indels into a single dataframe
+    (the nucleotide columns are decoded from bytes here)
+    the position columns are copied into preallocated int32 arrays (one row per indel found)
+    and the dataframe is built once
+    '''
+    num_indels_list = [column_dict['seq_start_pos'].size for column_dict in column_dict_list]
+    num_rows = sum(num_indels_list)
+
+    ref_start_arr = np.empty(num_rows, dtype = np.int32)
+    seq_start_arr = np.empty(num_rows, dtype = np.int32)
+    length_arr = np.empty(num_rows, dtype = np.int32)
+
+    k = 0
+    for column_dict, num_indels in zip(column_dict_list, num_indels_list):
+        ref_start_arr[k: k + num_indels] = column_dict['ref_start_pos']
+        seq_start_arr[k: k + num_indels] = column_dict['seq_start_pos']
+        length_arr[k: k + num_indels] = column_dict['length']
+        k = k + num_indels
+
+    sample_id_arr = np.array([column_dict['accession_id'] for column_dict in column_dict_list], dtype = object)
+
+    # the nucleotide columns are built as object arrays so an empty table keeps string columns, not float64
+    df_dict = {'accession_id': np.repeat(sample_id_arr, num_indels_list),
+               'indel': np.array([item.decode('ascii') for column_dict in column_dict_list for item in column_dict['indel']], dtype = object),
+               # deletions do not have a ref start position (kernel writes -1); leave these blank
+               'ref_start_pos': pd.arrays.IntegerArray(ref_start_arr, mask = ref_start_arr < 0),
+               'seq_start_pos': seq_start_arr,
+               'length': length_arr,
+               'upstream_ref': np.array([item.decode('ascii') for column_dict in column_dict_list for item in column_dict['upstream_ref']], dtype = object),
+               'downstream_ref': np.array([item.decode('ascii') for column_dict in column_dict_list for item in column_dict['downstream_ref']], dtype = object)}
+
+    return pd.DataFrame(df_dict, columns = INDEL_COLUMNS)
+
+def record_indels(alignments, ref_arr):
+    '''
+    records but does NOT remove insertions from sequences and records deletions
+    alignments is any iterable of (sample_id, packed_ref, packed_sample, aln_len); it is consumed once
+    '''
+    insertions_list = []
+    deletions_list = []
+    for alignment_name, packed_ref, packed_sample, aln_len in alignments:
+        indels = extract_indels(packed_ref = packed_ref,
+                                packed_sample = packed_sample,
+                                aln_len = aln_len,
+                                sample_id = alignment_name,
+                                ref_arr = ref_arr)
 
-                                    # get the sequence around the deletion
-                                    upstream = ref_str[seq_start-7: seq_start]
-                                    downstream = ref_str[seq_start: seq_start + 7]
+        num_insertions = indels['insertions']['seq_start_pos'].size
+        if num_insertions > 0:
+            print('  ....found %d insertion(s) in %s' % (num_insertions, alignment_name))
 
-                                    upstream_list.append(upstream)
-                                    downstream_list.append(downstream)
+        insertions_list.append(indels['insertions'])
+        deletions_list.append(indels['deletions'])
 
-    df = pd.DataFrame()
-    df['accession_id'] = seq_list
-    df['indel'] = ref_seq_list
-    df['ref_start_pos'] = ref_start_list
-    df['seq_start_pos'] = seq_start_list
-    df['length'] = length_list
-    df['upstream_ref'] = upstream_list
-    df['downstream_ref'] = downstream_list
+    insertions_df = concat_indel_columns(insertions_list)
+    deletions_df = concat_indel_columns(deletions_list)
 
-    return df
+    return {'insertions_df': insertions_df,
+            'deletions_df': deletions_df,
+            'mod_seq_list': insertions_df['accession_id'].tolist()}
 
 
 def join_insertion_and_deletions_dfs(insertions_df, deletions_df, prefix, wd):
     print('')
-    print('5- writing indel table to csv')
-
-    if insertions_df.shape[0] > 0 and deletions_df.shape[0] > 0:
-        dataframe_list = [insertions_df, deletions_df]
-        joined_df = pd.concat(dataframe_list)
-    elif insertions_df.shape[0] > 0:
-        joined_df = insertions_df
-    elif deletions_df.shape[0] >0:
-        joined_df = deletions_df
-    else:
-        joined_df = pd.DataFrame()
-        joined_df['accession_id'] = ''
-        joined_df['indel'] = ''
-        joined_df['start_pos'] = ''
-        joined_df['length'] = ''
-        joined_df['upstream_ref'] = ''
-        joined_df['downstream_ref'] = ''
+    print('3- writing indel table to csv')
+
+    # both dataframes have the same columns (and are empty rather than missing when nothing is found)
+    # so they can always be concatenated
+    joined_df = pd.concat([insertions_df, deletions_df], ignore_index = True)
 
     outfile = os.path.join(wd, '%s_indels.csv' % prefix)
     joined_df.to_csv(outfile, index = False)
     print('  ....indel table csv file name: %s' % outfile)
 
 
-def create_concatenated_seq_records(wd, temp_alignment_dir, mod_seq_list, ref_genome, prefix):
-    print('')
-    print('5- concatenating sequence records into a MSA file')
-
-    # create file that will append each record to
-    concat_fasta_outfile = os.path.join(wd, '%s.alignment.fasta' % prefix)
-    if os.path.exists(concat_fasta_outfile):
-        os.remove(concat_fasta_outfile)
-    print('  ....MSA file name: %s' % concat_fasta_outfile)
-
-#     # first add the reference sequence
-#     with open(concat_fasta_outfile, 'w') as handle:
-#         SeqIO.write(ref_genome, handle, 'fasta')
-
-    # first append the non - modified records
-    os.chdir(temp_alignment_dir)
-    for file in glob.glob('*.fasta'):
-        sample_name = file.split('.alignment.fasta')[0]
-#         if sample_name not in mod_seq_list:
-        for record in AlignIO.read(file, 'fasta'):
-            if record.id == sample_name:
-                with open(concat_fasta_outfile, 'a') as handle:
-                    SeqIO.write(record, handle, 'fasta')
-
-
-    num_seqs = len(list(SeqIO.parse(concat_fasta_outfile, 'fasta')))
-    # get length of sequences:
-    seq_len_list = []
-    for record in SeqIO.parse(concat_fasta_outfile, 'fasta'):
-        seq_len = len(record.seq)
-        if seq_len not in seq_len_list:
-            seq_len_list.append(seq_len)
+def create_concatenated_seq_records(alignments, handle, msa_outfile):
+    '''
+    writes each aligned sample sequence to the open MSA file handle as the alignments stream past
+    and passes every alignment on unchanged; the sequences and their lengths are counted while writing
+    '''
+    num_seqs = 0
+    seq_len_set = set()
+    for alignment in alignments:
+        sample_name, packed_ref, packed_sample, aln_len = alignment
+
+        # the packed sample sequence is only decoded here, as it is written
+        aligned_sample = decode_nt(packed_sample, 0, aln_len, NT_DECODE)
+        handle.write(b'>%s\n%s\n' % (sample_name.encode('ascii'), aligned_sample.tobytes()))
+        num_seqs = num_seqs + 1
+        seq_len_set.add(aln_len)
 
+        yield alignment
+
+    print('  ....MSA file name: %s' % msa_outfile)
     print('  ...."alignment" has %d sequences' % num_seqs)
     print('  ....sequnce "alignment" length is:')
-    for seq_len in seq_len_list:
+    for seq_len in sorted(seq_len_set):
         print('  .... .... %d' % seq_len)
 
 
@@ -419,12 +613,7 @@ if __name__ == '__main__':
 
     # get the refernce genome
     ref = get_ref_seq_record(ref_genome_path = ref_path)
-    # ref['ref_id'] or ref['ref_seq'] or ref['ref_record']
-
-    # create temp directories
-    temp_dirs = create_temp_directories(wd)
-    # temp_dirs['alignment_temp_dir'] or temp_dirs['fasta_temp_dir']
-
+    # ref['ref_id'] or ref['ref_seq'] or ref['ref_record'] or ref['ref_arr']
 
     #determine input type and create multifasta if neccessary:
     if re.search('.fa', options.input):
@@ -444,46 +633,32 @@ if __name__ == '__main__':
         print('multi sequence fasta saved to: %s' % multifasta)
 
 
-    # add reference genome to each fasta file in temp fasta directory
-    num_records = add_ref_genome(multifasta = multifasta,
-                  ref_genome =ref['ref_record'],
-                  fasta_temp_dir = temp_dirs['fasta_temp_dir'])
+    # count the sample sequences and check for duplicated record.ids
+    num_records = count_records(multifasta = multifasta)
 
-    # do alignment adn save alignment to temp alignment directory
-    align_sequences(fasta_temp_dir = temp_dirs['fasta_temp_dir'],
-                    alignment_temp_dir = temp_dirs['alignment_temp_dir'],
-                   num_records = num_records)
+    # align, write the MSA and record the insertions and deletions in a single pass over the samples;
+    # each alignment is done in memory and dropped once its indels are recorded
+    msa_outfile = os.path.join(wd, '%s.alignment.fasta' % prefix)
+    with open(msa_outfile, 'wb', buffering = 1<<20) as msa_handle:
+        alignments = pairwise_align_sequences(multifasta = multifasta,
+                                              ref_arr = ref['ref_arr'],
+                                              num_records = num_records)
+        # yields (sample_id, packed_ref, packed_sample, aln_len)
 
+        alignments = create_concatenated_seq_records(alignments = alignments,
+                                                     handle = msa_handle,
+                                                     msa_outfile = msa_outfile)
 
-    # remove and record the insertions
-    insertions = remove_insertions(alignment_temp_dir = temp_dirs['alignment_temp_dir'],
-                               ref_id = ref['ref_id'],
-                               ref_seq = ref['ref_seq'] )
-    # insertions['insertions_df'] or insert['mod_seq_list']
-
-    # record deletions
-    deletions_df = record_deletions(alignment_temp_dir = temp_dirs['alignment_temp_dir'],
-                     ref_seq = ref['ref_seq'],
-                     mod_seq_list = insertions['mod_seq_list'],
-                                   ref_id = ref['ref_id'])
+        indels = record_indels(alignments = alignments,
+                               ref_arr = ref['ref_arr'])
+        # indels['insertions_df'] or indels['deletions_df'] or indels['mod_seq_list']
 
     # write out indel table
-    join_insertion_and_deletions_dfs(insertions_df = insertions['insertions_df'],
-                                  deletions_df = deletions_df,
+    join_insertion_and_deletions_dfs(insertions_df = indels['insertions_df'],
+                                  deletions_df = indels['deletions_df'],
                                   prefix = prefix,
                                   wd = wd)
 
-    # write MSA
-    create_concatenated_seq_records(wd = wd,
-                                    temp_alignment_dir = temp_dirs['alignment_temp_dir'],
-                                    mod_seq_list = insertions['mod_seq_list'],
-                                    ref_genome = ref['ref_record'] ,
-                                    prefix = prefix)
-
-    # remove temp directories...
-    delete_temp_directory(directory_name = temp_dirs['alignment_temp_dir'])
-    delete_temp_directory(directory_name = temp_dirs['fasta_temp_dir'])
-
     print('********************************')
     print('DONE!')
     print('')
@@ -5,6 +5,11 @@ import re
 import pandas as pd 
 import sys
 import json
+# orjson is faster but is not in every docker image; fall back to the standard json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 import argparse
 
@@ -31,119 +36,101 @@ def getOptions(args=sys.argv[1:]):
     return options
 
 
-def extract_variant_list(json_path, seq_run_file_list):
-
-    # create pd data frame to fill
-    df = pd.DataFrame()
-    accession_id_list = []
-    mutation_list = []
-    gene_list = []
-    refAA_list = []
-    altAA_list = []
-    codon_pos_list = []
-    nuc_start_list = []
-    nuc_end_list = []
-
-
-    with open(json_path) as f:
-        data = json.load(f)
-
-    for i in range(len(data['results'])):
-
-    #     print(data[i]['seqName'])
-        if 'aaDeletions' in data['results'][i].keys():
-            aa_deletions = data['results'][i]['aaDeletions']
-            for item in aa_deletions:
-                gene=item['gene']
-                refAA= item['refAA']
-                altAA= 'del'
-                pos=item['codon'] + 1
-                nuc_start = item['codonNucRange']['begin']
-                nuc_end = item['codonNucRange']['end']
-
-                mutation = '%s_%s%d%s' % (gene, refAA, pos, altAA)
-                
-                accession_id_list.append(data['results'][i]['seqName'])
-                mutation_list.append(mutation)
-                gene_list.append(gene)
-                refAA_list.append(refAA)
-                altAA_list.append(altAA)
-                codon_pos_list.append(pos)
-                nuc_start_list.append(nuc_start)
-                nuc_end_list.append(nuc_end)
-                
-        if 'insertions' in data['results'][i].keys():
-            insertions = data['results'][i]['insertions']
-            for item in insertions:
-                gene= ''
-                refAA= 'ins'
-                altAA= item['ins']
-                pos=item['pos'] + 1
-                nuc_start = item['pos'] + 1
-                
-                # to find length now that update removed length key
-                insert_seq = item['ins']
-                length = len(insert_seq)
-                #####
-                
-                nuc_end = item['pos'] + 1 + length
-
-                mutation = '%s_%s%d%s' % (gene, refAA, pos, altAA)
-                
-                accession_id_list.append(data['results'][i]['seqName'])
-                mutation_list.append(mutation)
-                gene_list.append(gene)
-                refAA_list.append(refAA)
-                altAA_list.append(altAA)
-                codon_pos_list.append(pos)
-                nuc_start_list.append(nuc_start)
-                nuc_end_list.append(nuc_end)
-
-        if 'aaSubstitutions' in data['results'][i].keys():
-            aa_subs = data['results'][i]['aaSubstitutions']
-            for item in aa_subs:
-                gene = item['gene']
-                refAA = item['refAA']
-                if item['queryAA'] == '*':
-                    altAA = 'stop'
-                else:
-                    altAA = item['queryAA']     
-                
-                pos = item['codon'] + 1
-                nuc_start = item['codonNucRange']['begin']
-                nuc_end = item['codonNucRange']['end']
-
-                mutation = '%s_%s%d%s' % (gene, refAA, pos, altAA)
-                accession_id_list.append(data['results'][i]['seqName'])
-                mutation_list.append(mutation)
-                gene_list.append(gene)
-                refAA_list.append(refAA)
-                altAA_list.append(altAA)
-                codon_pos_list.append(pos)
-                nuc_start_list.append(nuc_start)
-                nuc_end_list.append(nuc_end)
-
-
-    df['accession_id'] = accession_id_list
-    df['variant_name'] = mutation_list
-    df['gene'] = gene_list
-    df['codon_position'] = codon_pos_list
-    df['refAA'] = refAA_list
-    df['altAA'] = altAA_list
-    df['start_nuc_pos'] = nuc_start_list
-    df['end_nuc_pos'] = nuc_end_list
-
-        
-    seq_run_list = []
-    with open(seq_run_file_list, 'r') as f:
-        for line in f:
-            seq_run_list.append(line.strip())
-        
-    path = '%s_nextclade_variant_summary.csv' % seq_run_list[0]
+def explode_mutations(results, key):
+    # flattens one list of mutations (e.g. 'aaDeletions') from the nextclade results into a
+    # data frame with one row per mutation; the seqName and the position of the sample in the
+    # results are kept so the original sample order can be restored
+    if key not in results.columns:
+        return pd.DataFrame()
+
+    exploded = results[['seqName', key]].explode(key).dropna(subset = [key])
+    if exploded.shape[0] == 0:
+        return pd.DataFrame()
+
+    mutations = pd.json_normalize(exploded[key].tolist())
+    mutations['seqName'] = exploded['seqName'].values
+    mutations['sample_order'] = exploded.index.values
+
+    return mutations
+
+
+def load_nextclade_json(json_path):
+    # the nextclade json can be large; parse it once (with orjson if installed) and share the dict
+    with open(json_path, 'rb') as f:
+        if orjson is not None:
+            data = orjson.loads(f.read())
+        else:
+            data = json.loads(f.read())
+    return data
+
+
+def extract_variant_list(data, prefix):
+
+    # one row per sample; the mutation lists are flattened with json_normalize below
+    results = pd.DataFrame(data['results'])
+
+    # list of data frames to concat; mutation_type keeps deletions, insertions and
+    # substitutions in that order within each sample
+    df_list = []
+
+    aa_deletions = explode_mutations(results, 'aaDeletions')
+    if aa_deletions.shape[0] > 0:
+        del_df = pd.DataFrame()
+        del_df['sample_order'] = aa_deletions['sample_order']
+        del_df['mutation_type'] = 0
+        del_df['accession_id'] = aa_deletions['seqName']
+        del_df['gene'] = aa_deletions['gene']
+        del_df['codon_position'] = aa_deletions['codon'] + 1
+        del_df['refAA'] = aa_deletions['refAA']
+        del_df['altAA'] = 'del'
+        del_df['start_nuc_pos'] = aa_deletions['codonNucRange.begin']
+        del_df['end_nuc_pos'] = aa_deletions['codonNucRange.end']
+        df_list.append(del_df)
+
+    insertions = explode_mutations(results, 'insertions')
+    if insertions.shape[0] > 0:
+        # to find length now that update removed length key use the length of the insert seq
+        ins_df = pd.DataFrame()
+        ins_df['sample_order'] = insertions['sample_order']
+        ins_df['mutation_type'] = 1
+        ins_df['accession_id'] = insertions['seqName']
+        ins_df['gene'] = ''
+        ins_df['codon_position'] = insertions['pos'] + 1
+        ins_df['refAA'] = 'ins'
+        ins_df['altAA'] = insertions['ins']
+        ins_df['start_nuc_pos'] = insertions['pos'] + 1
+        ins_df['end_nuc_pos'] = insertions['pos'] + 1 + insertions['ins'].str.len()
+        df_list.append(ins_df)
+
+    aa_subs = explode_mutations(results, 'aaSubstitutions')
+    if aa_subs.shape[0] > 0:
+        sub_df = pd.DataFrame()
+        sub_df['sample_order'] = aa_subs['sample_order']
+        sub_df['mutation_type'] = 2
+        sub_df['accession_id'] = aa_subs['seqName']
+        sub_df['gene'] = aa_subs['gene']
+        sub_df['codon_position'] = aa_subs['codon'] + 1
+        sub_df['refAA'] = aa_subs['refAA']
+        sub_df['altAA'] = aa_subs['queryAA'].where(aa_subs['queryAA'] != '*', 'stop')
+        sub_df['start_nuc_pos'] = aa_subs['codonNucRange.begin']
+        sub_df['end_nuc_pos'] = aa_subs['codonNucRange.end']
+        df_list.append(sub_df)
+
+    columns = ['accession_id', 'variant_name', 'gene', 'codon_position', 'refAA', 'altAA', 'start_nuc_pos', 'end_nuc_pos']
+    if len(df_list) > 0:
+        df = pd.concat(df_list, ignore_index = True)
+        df = df.sort_values(by = ['sample_order', 'mutation_type'], kind = 'mergesort')
+        df['variant_name'] = df['gene'] + '_' + df['refAA'] + df['codon_position'].astype(str) + df['altAA']
+        df = df[columns]
+    else:
+        df = pd.DataFrame(columns = columns)
+
+
+    path = '%s_nextclade_variant_summary.csv' % prefix
     df.to_csv(path, index=False)
     
     
-def get_nextclade(json_path, seq_run_file_list):
+def get_nextclade(data, prefix):
 
     # create pd data frame to fill
     accession_id_list = []
@@ -158,9 +145,6 @@ def get_nextclade(json_path, seq_run_file_list):
     
     df = pd.DataFrame()
 
-    with open(json_path) as f:
-        data = json.load(f)
-
     for i in range(len(data['results'])):
         if 'clade' in data['results'][i].keys():
             accession_id_list.append(data['results'][i]['seqName'])
@@ -180,18 +164,19 @@ def get_nextclade(json_path, seq_run_file_list):
     df['total_AA_substitutions'] = totalAASubstitutions_list
     df['total_AA_deletions'] = totalAADeletions_list
     
-    seq_run_list = []
-    with open(seq_run_file_list, 'r') as f:
-        for line in f:
-            seq_run_list.append(line.strip())
-
-    path = '%s_nextclade_results.csv' % seq_run_list[0]
+    path = '%s_nextclade_results.csv' % prefix
     df.to_csv(path, index = False)
 
     
 if __name__ == '__main__':
     
     options = getOptions()
-    get_nextclade(json_path = options.nextclade_json, seq_run_file_list = options.seq_run_file_list)
-    extract_variant_list(json_path = options.nextclade_json, seq_run_file_list = options.seq_run_file_list)
+    data = load_nextclade_json(json_path = options.nextclade_json)
+
+    # the output files are named after the first seq_run in the list
+    with open(options.seq_run_file_list, 'r') as f:
+        prefix = f.readline().strip()
+
+    get_nextclade(data = data, prefix = prefix)
+    extract_variant_list(data = data, prefix = prefix)
         
\ No newline at end of file